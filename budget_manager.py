@@ -1,51 +1,90 @@
-import json
+import asyncio
+import hashlib
 import logging
-from datetime import date, timezone, datetime
-from typing import List, Dict, Any, Optional
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 
+import orjson
 import tiktoken
 import redis.asyncio as redis
+from redis.exceptions import NoScriptError
 
 from config import settings, MODEL_PRICING, DEFAULT_PRICING
 
 logger = logging.getLogger("ai-firewall.budget")
 
-_redis_pool: Optional[redis.Redis] = None
-_encoding: Optional[tiktoken.Encoding] = None
-
-
-async def get_redis() -> redis.Redis:
-    """Return a shared async Redis connection."""
-    global _redis_pool
-    if _redis_pool is None:
-        _redis_pool = redis.from_url(
-            settings.REDIS_URL, decode_responses=True
-        )
-    return _redis_pool
-
-
-def get_encoding() -> tiktoken.Encoding:
-    """Return a cached tiktoken encoding instance."""
-    global _encoding
-    if _encoding is None:
-        _encoding = tiktoken.get_encoding(settings.TIKTOKEN_ENCODING)
-    return _encoding
+# Daily budget keys live for 48h so they outlast any timezone offset
+BUDGET_KEY_TTL = 48 * 3600
+
+# How long a worker may serve a user's spend from its local cache; a soft
+# budget tolerates this much staleness
+BUDGET_CACHE_TTL = 1.0
+
+# Number of prompt token counts memoized by _count_cached
+TOKEN_CACHE_SIZE = 4096
+
+# How long the flusher waits after the first queued increment so that
+# concurrent requests land in the same pipeline
+SPEND_FLUSH_INTERVAL = 0.005
+
+# How long the flusher waits before retrying increments that failed to apply
+SPEND_RETRY_INTERVAL = 1.0
+
+# Atomically add ARGV[1] USD to the spend key, refresh its TTL (ARGV[2]) and
+# report whether the new total has reached the limit (ARGV[3]).
+# Returns {new_total, over_limit}.
+_SPEND_SCRIPT = """
+local total = redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if tonumber(total) >= tonumber(ARGV[3]) then
+    return {total, 1}
+end
+return {total, 0}
+"""
+
+# Shared clients, created by init() during application startup
+REDIS: Optional[redis.Redis] = None
+ENC: Optional[tiktoken.Encoding] = None
+# SHA1 of _SPEND_SCRIPT, loaded into the script cache by init()
+_spend_sha: Optional[str] = None
+# Pending (user, amount) increments; None asks the flusher to stop.
+# Created by init() so it binds to the running event loop.
+_spend_queue: "Optional[asyncio.Queue[Optional[Tuple[str, float]]]]" = None
+_flusher_task: Optional[asyncio.Task] = None
+# Prompt digest → token count, least recently used first
+_token_counts: "OrderedDict[bytes, int]" = OrderedDict()
+# user → (spent, monotonic expiry) of the last known daily spend
+_spent_cache: Dict[str, Tuple[float, float]] = {}
+# [UTC day number, "YYYY-MM-DD"] of the last budget key built
+_today_cache: List[Any] = [0, ""]
 
 
 def _budget_key(user: str) -> str:
     """Redis key for the user's daily spend: budget:{user}:{YYYY-MM-DD}."""
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    return f"budget:{user}:{today}"
+    day = int(time.time()) // 86400
+    if day != _today_cache[0]:
+        _today_cache[0] = day
+        _today_cache[1] = time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+    return f"budget:{user}:{_today_cache[1]}"
 
 
 # ── Budget checks ────────────────────────────────────────────────────────────
 
 
 async def get_spent(user: str) -> float:
-    """Return how much the user has spent today (USD)."""
-    r = await get_redis()
-    val = await r.get(_budget_key(user))
-    return float(val) if val else 0.0
+    """Return how much the user has spent today (USD).
+
+    Values are cached per process for BUDGET_CACHE_TTL seconds.
+    """
+    now = time.monotonic()
+    cached = _spent_cache.get(user)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    val = await REDIS.get(_budget_key(user))
+    spent = float(val) if val else 0.0
+    _spent_cache[user] = (spent, now + BUDGET_CACHE_TTL)
+    return spent
 
 
 async def check_budget(user: str) -> bool:
@@ -54,91 +93,380 @@ async def check_budget(user: str) -> bool:
     return spent < settings.DAILY_BUDGET_LIMIT
 
 
-async def increment_spend(user: str, amount: float) -> float:
-    """Add `amount` USD to the user's daily spend. Returns new total."""
-    r = await get_redis()
-    key = _budget_key(user)
-    new_total = await r.incrbyfloat(key, round(amount, 8))
-    # Set TTL to 48h so keys auto-expire (covers timezone edge cases)
-    await r.expire(key, 48 * 3600)
-    logger.info("User %s spend updated: +$%.6f → $%.6f", user, amount, new_total)
-    return float(new_total)
+def increment_spend(user: str, amount: float) -> None:
+    """Queue `amount` USD to be added to the user's daily spend.
+
+    The write is performed asynchronously by the spend flusher, which
+    coalesces concurrent updates into a single Redis pipeline.
+    """
+    _spend_queue.put_nowait((user, amount))
+
+
+class _SpendNotSent(Exception):
+    """No Redis connection was available, so no increment was sent."""
+
+
+async def _eval_spend(items: List[Tuple[str, float]]) -> List[Any]:
+    """Run the spend script for each (user, amount) in one pipeline round-trip.
+
+    Per-command errors are returned in place of results, not raised. Raises
+    _SpendNotSent when the batch could not be sent at all, so it is safe to
+    retry; any other exception means it may already have been applied.
+    """
+    # Each script call is atomic on its own, so no MULTI/EXEC is needed
+    async with REDIS.pipeline(transaction=False) as pipe:
+        for user, amount in items:
+            pipe.evalsha(
+                _spend_sha,
+                1,
+                _budget_key(user),
+                round(amount, 8),
+                BUDGET_KEY_TTL,
+                settings.DAILY_BUDGET_LIMIT,
+            )
+        # Check out (and connect) the connection up front; the pipeline uses
+        # it for execute() and releases it when the block exits
+        try:
+            pipe.connection = await REDIS.connection_pool.get_connection("EVALSHA")
+        except Exception as exc:
+            raise _SpendNotSent() from exc
+        return await pipe.execute(raise_on_error=False)
+
+
+async def _flush_spend(pending: Dict[str, float]) -> Dict[str, float]:
+    """Apply coalesced per-user increments to Redis.
+
+    Returns the increments that were rejected with NOSCRIPT and never ran;
+    these are the only ones that can safely be retried.
+    """
+    global _spend_sha
+    items = list(pending.items())
+    results = await _eval_spend(items)
+
+    failed: Dict[str, float] = {}
+    expires = time.monotonic() + BUDGET_CACHE_TTL
+    for (user, amount), result in zip(items, results):
+        if isinstance(result, NoScriptError):
+            failed[user] = amount
+            continue
+        if isinstance(result, Exception):
+            # Retrying would fail the same way (e.g. WRONGTYPE)
+            logger.error("Dropping spend +$%.6f for user %s: %s", amount, user, result)
+            continue
+        new_total, over_limit = result
+        _spent_cache[user] = (float(new_total), expires)
+        logger.info(
+            "User %s spend updated: +$%.6f → $%.6f", user, amount, float(new_total)
+        )
+        if over_limit:
+            logger.warning("User %s reached the daily budget limit", user)
+
+    if failed:
+        # The script cache was emptied (restart/SCRIPT FLUSH): reload it so
+        # the flusher's retry of these increments can run
+        try:
+            _spend_sha = await REDIS.script_load(_SPEND_SCRIPT)
+        except Exception:
+            logger.exception("Error reloading the spend script")
+    return failed
+
+
+def _coalesce(pending: Dict[str, float], item: Optional[Tuple[str, float]]) -> bool:
+    """Merge a queued item into `pending`; return False for the stop sentinel."""
+    if item is None:
+        return False
+    user, amount = item
+    pending[user] = pending.get(user, 0.0) + amount
+    return True
+
+
+async def _spend_flusher() -> None:
+    """Background task: drain the spend queue and write each batch at once.
+
+    Increments that were certainly not applied are kept and merged into the
+    next batch.
+    """
+    pending: Dict[str, float] = {}
+    running = True
+    while running:
+        if pending:
+            # The previous flush failed; back off, then retry with new items
+            await asyncio.sleep(SPEND_RETRY_INTERVAL)
+        else:
+            running = _coalesce(pending, await _spend_queue.get())
+            await asyncio.sleep(SPEND_FLUSH_INTERVAL)
+        while not _spend_queue.empty():
+            running = _coalesce(pending, _spend_queue.get_nowait()) and running
+
+        if pending:
+            try:
+                pending = await _flush_spend(pending)
+            except _SpendNotSent:
+                logger.exception("Redis unavailable, will retry budget updates")
+            except Exception:
+                # The commands were sent and may have been applied before the
+                # reply was lost; retrying could bill these users twice
+                logger.exception("Error flushing budget updates, dropping: %s", pending)
+                pending = {}
+
+    if pending:
+        logger.error("Shutting down with unapplied spend: %s", pending)
 
 
 # ── Token counting ───────────────────────────────────────────────────────────
 
 
 def count_tokens_for_messages(messages: List[Dict[str, Any]]) -> int:
-    """Count tokens for an OpenAI-style messages list."""
-    enc = get_encoding()
-    num_tokens = 0
-    for msg in messages:
-        # Every message has role + content overhead (~4 tokens per message)
-        num_tokens += 4
-        for key, value in msg.items():
-            if isinstance(value, str):
-                num_tokens += len(enc.encode(value))
-    num_tokens += 2  # priming tokens
-    return num_tokens
+    """Count tokens for an OpenAI-style messages list.
+
+    All string fields are joined with control-character separators and
+    encoded in one call; the separators slightly overcount, which errs on
+    the safe side for budget estimates.
+    """
+    text = "\x1e".join(
+        "\x1f".join(value for value in msg.values() if isinstance(value, str))
+        for msg in messages
+    )
+    # Every message has role + content overhead (~4 tokens per message)
+    return _count_cached(text) + 4 * len(messages) + 2  # + priming tokens
+
+
+def _count_cached(text: str) -> int:
+    """Token count memoized so retries and repeated prompts skip encoding.
+
+    Entries are keyed by a 16-byte digest so the cache never keeps prompt
+    text alive.
+    """
+    key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    count = _token_counts.get(key)
+    if count is None:
+        count = len(ENC.encode(text))
+        _token_counts[key] = count
+        if len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    else:
+        _token_counts.move_to_end(key)
+    return count
 
 
 def count_tokens_text(text: str) -> int:
     """Count tokens for a plain text string."""
-    enc = get_encoding()
-    return len(enc.encode(text))
+    return len(ENC.encode(text))
 
 
 # ── Cost calculation ─────────────────────────────────────────────────────────
 
 
-def get_pricing(model: str):
-    """Return (input_price_per_1k, output_price_per_1k) for a model."""
-    return MODEL_PRICING.get(model, DEFAULT_PRICING)
+# Per-token (input, output) prices, pre-divided from the per-1k tables
+COST_PER_TOKEN: Dict[str, Tuple[float, float]] = {
+    model: (input_price / 1000.0, output_price / 1000.0)
+    for model, (input_price, output_price) in MODEL_PRICING.items()
+}
+DEFAULT_PER_TOKEN: Tuple[float, float] = (
+    DEFAULT_PRICING[0] / 1000.0,
+    DEFAULT_PRICING[1] / 1000.0,
+)
 
 
 def compute_cost(model: str, input_tokens: int, output_tokens: int) -> float:
     """Compute total cost in USD for a given request."""
-    input_price, output_price = get_pricing(model)
-    cost = (input_tokens / 1000.0) * input_price + (output_tokens / 1000.0) * output_price
-    return cost
+    prices = COST_PER_TOKEN.get(model) if isinstance(model, str) else None
+    if prices is None:
+        if isinstance(model, str):
+            # Fall back to the bare model name: "openai/gpt-4o" → "gpt-4o"
+            prices = COST_PER_TOKEN.get(model.rpartition("/")[2], DEFAULT_PER_TOKEN)
+        else:
+            # Clients control this field; anything odd bills at the default
+            prices = DEFAULT_PER_TOKEN
+    input_price, output_price = prices
+    return input_tokens * input_price + output_tokens * output_price
 
 
 # ── SSE output token extraction ──────────────────────────────────────────────
 
 
-def extract_text_from_sse_chunks(chunks: List[str]) -> str:
-    """
-    Parse accumulated SSE chunks and extract the assistant's generated text.
-    Each chunk follows the format: data: {json}\n\n
-    """
-    full_text = []
-    for chunk in chunks:
-        for line in chunk.splitlines():
-            line = line.strip()
-            if not line.startswith("data:"):
-                continue
-            payload = line[len("data:"):].strip()
-            if payload == "[DONE]":
-                continue
+_CONTENT_KEY = b'"content"'
+_CONTENT_MARKER = b'"content":"'
+
+
+def _find_string_end(buf: bytes, quote: int) -> int:
+    """Index of the quote closing the JSON string opened at `quote`, or -1."""
+    end = buf.find(b'"', quote + 1)
+    while end != -1:
+        # The quote is escaped if preceded by an odd number of backslashes
+        j = end - 1
+        while buf[j] == 0x5C:
+            j -= 1
+        if (end - 1 - j) % 2 == 0:
+            return end
+        end = buf.find(b'"', end + 1)
+    return -1
+
+
+def _decode_json_fragments(parts: List[bytes]) -> str:
+    """Decode escaped JSON string bodies, all at once when possible."""
+    try:
+        return orjson.loads(b'"' + b"".join(parts) + b'"')
+    except orjson.JSONDecodeError:
+        # A malformed fragment should only cost its own event
+        text = []
+        for part in parts:
             try:
-                data = json.loads(payload)
-                choices = data.get("choices", [])
-                for choice in choices:
-                    delta = choice.get("delta", {})
-                    content = delta.get("content")
-                    if content:
-                        full_text.append(content)
-            except (json.JSONDecodeError, KeyError):
+                text.append(orjson.loads(b'"' + part + b'"'))
+            except orjson.JSONDecodeError:
                 continue
-    return "".join(full_text)
+        return "".join(text)
+
+
+_USAGE_KEY = b'"usage"'
+_USAGE_NULL = b'"usage":null'
 
 
-# ── Cleanup ──────────────────────────────────────────────────────────────────
+class SSEBillingParser:
+    """
+    Incrementally extract the generated text and `usage` from an SSE stream.
+
+    Chunks are fed as they are proxied; complete lines are parsed right away
+    and discarded, so only the escaped content fragments are kept. Events
+    follow the format: data: {json}\n\n
+
+    With `strip_usage`, the usage-only event (empty choices) requested by the
+    proxy is removed from the forwarded bytes, for clients that did not ask
+    for stream_options.include_usage themselves.
+    """
+
+    def __init__(self, strip_usage: bool = False) -> None:
+        self._strip_usage = strip_usage
+        self._pending = bytearray()
+        self._parts: List[bytes] = []
+        # Drop the blank line terminating a stripped usage event
+        self._drop_blank = False
+        # Provider-reported usage (stream_options.include_usage), if any
+        self.usage: Optional[Dict[str, Any]] = None
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Consume a chunk of the stream and return the bytes to forward.
+
+        Without `strip_usage` this is the chunk itself. Otherwise it is every
+        completed line except the usage-only event; a partial trailing line
+        is held back until it completes.
+        """
+        pending = self._pending
+        pending.extend(chunk)
+        start = 0
+        forward = bytearray()
+        kept = 0  # start of completed bytes not yet copied to `forward`
+        # Earlier bytes were already scanned and hold no newline
+        end = pending.find(b"\n", len(pending) - len(chunk))
+        while end != -1:
+            if pending.startswith(b"data:", start):
+                usage_only = self._handle_payload(pending[start + 5:end])
+                drop = self._drop_blank = usage_only and self._strip_usage
+            else:
+                drop = self._drop_blank and end - start <= 1 and pending[start] in b"\r\n"
+                self._drop_blank = False
+            if drop:
+                forward += pending[kept:start]
+                kept = end + 1
+            start = end + 1
+            end = pending.find(b"\n", start)
+        if not self._strip_usage:
+            if start:
+                del pending[:start]
+            return chunk
+        forward += pending[kept:start]
+        if start:
+            del pending[:start]
+        return bytes(forward)
+
+    def finish(self) -> bytes:
+        """Parse a trailing event that was not newline-terminated.
+
+        Returns the held-back bytes still to be forwarded, if any.
+        """
+        tail = bytes(self._pending)
+        self._pending.clear()
+        usage_only = tail.startswith(b"data:") and self._handle_payload(tail[5:])
+        if not self._strip_usage or usage_only:
+            return b""
+        return tail
+
+    def output_text(self) -> str:
+        """Return the assistant's generated text seen so far."""
+        return _decode_json_fragments(self._parts) if self._parts else ""
+
+    def _handle_payload(self, payload: bytes) -> bool:
+        """Record content/usage from one data payload.
+
+        Returns True for a usage-only event (usage present, no choices).
+        """
+        # Events carrying a single compact "content" string are sliced
+        # directly from the payload; anything else gets a full JSON parse.
+        if _USAGE_KEY not in payload or _USAGE_NULL in payload:
+            keys = payload.count(_CONTENT_KEY)
+            if keys == 0:
+                return False
+            if keys == 1:
+                pos = payload.find(_CONTENT_MARKER)
+                if pos != -1:
+                    quote = pos + len(_CONTENT_MARKER) - 1
+                    close = _find_string_end(payload, quote)
+                    if close != -1:
+                        if close > quote + 1:
+                            self._parts.append(payload[quote + 1:close])
+                        return False
+        try:
+            data = orjson.loads(payload)
+            usage = data.get("usage")
+            if isinstance(usage, dict):
+                self.usage = usage
+            choices = data.get("choices") or []
+            for choice in choices:
+                delta = choice.get("delta") or {}
+                content = delta.get("content")
+                if content:
+                    # Re-escape so it joins the raw fragments on decode
+                    self._parts.append(orjson.dumps(content)[1:-1])
+        except Exception:
+            # Runs inline in the proxy's data path: an unexpected event shape
+            # must only cost billing accuracy, never the client's stream
+            return False
+        return isinstance(usage, dict) and not choices
+
+
+# ── Lifecycle ────────────────────────────────────────────────────────────────
+
+
+async def init() -> None:
+    """Create the shared Redis client and encoding, start the spend flusher."""
+    global REDIS, ENC, _spend_sha, _spend_queue, _flusher_task
+    ENC = tiktoken.get_encoding(settings.TIKTOKEN_ENCODING)
+    pool = redis.BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        decode_responses=True,
+        socket_keepalive=True,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    # from_pool hands ownership of the pool to the client, so aclose() frees it
+    REDIS = redis.Redis.from_pool(pool)
+    # Connect now so the first request does not pay for DNS/TCP setup, and
+    # load the spend script so flushes can queue plain EVALSHA commands
+    await REDIS.ping()
+    _spend_sha = await REDIS.script_load(_SPEND_SCRIPT)
+    _spend_queue = asyncio.Queue()
+    _flusher_task = asyncio.create_task(_spend_flusher())
 
 
 async def close() -> None:
-    """Close the Redis connection pool."""
-    global _redis_pool
-    if _redis_pool is not None:
-        await _redis_pool.aclose()
-        _redis_pool = None
+    """Flush queued spend and close the Redis connection pool."""
+    global REDIS, _flusher_task
+    if _flusher_task is not None:
+        _spend_queue.put_nowait(None)
+        await _flusher_task
+        _flusher_task = None
+    if REDIS is not None:
+        await REDIS.aclose()
+        REDIS = None
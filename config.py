@@ -12,9 +12,23 @@ class Settings(BaseSettings):
     # Upstream provider API key
     UPSTREAM_API_KEY: str = ""
 
+    # Upstream HTTP connection pool: total connections, how many are kept
+    # alive between requests, and for how long (seconds)
+    UPSTREAM_MAX_CONNECTIONS: int = 500
+    UPSTREAM_MAX_KEEPALIVE: int = 100
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 60.0
+
     # Redis
     REDIS_URL: str = "redis://redis:6379/0"
 
+    # Redis connection pool: requests wait up to REDIS_POOL_TIMEOUT seconds
+    # for a free connection instead of opening more than the maximum; idle
+    # connections are health-checked after REDIS_HEALTH_CHECK_INTERVAL seconds
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5.0
+    REDIS_SOCKET_TIMEOUT: float = 1.0
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+
     # Daily budget limit per user (in USD)
     DAILY_BUDGET_LIMIT: float = 5.0
 
@@ -38,9 +52,8 @@ MODEL_PRICING: Dict[str, Tuple[float, float]] = {
     "claude-3-5-sonnet-20241022": (0.0030, 0.0150),
     "claude-3-5-haiku-20241022": (0.0008, 0.0040),
     "claude-3-opus-20240229": (0.0150, 0.0750),
-    # OpenRouter prefixed
-    "openai/gpt-4o": (0.0025, 0.0100),
-    "openai/gpt-4o-mini": (0.000150, 0.000600),
+    # OpenRouter prefixed ("provider/model" names whose bare model is listed
+    # above, e.g. "openai/gpt-4o", resolve to that entry)
     "anthropic/claude-3.5-sonnet": (0.0030, 0.0150),
     "anthropic/claude-3.5-haiku": (0.0008, 0.0040),
     "anthropic/claude-3-opus": (0.0150, 0.0750),
@@ -1,12 +1,11 @@
 import asyncio
-import json
 import logging
 from contextlib import asynccontextmanager
-from typing import List
 
 import httpx
+import orjson
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 import budget_manager as bm
@@ -24,11 +23,33 @@ logger = logging.getLogger("ai-firewall")
 
 _http_client: httpx.AsyncClient | None = None
 
+# Headers forwarded to the upstream provider, built once at startup
+UPSTREAM_HEADERS: dict = {}
+# Streaming variant: raw chunks are forwarded verbatim, so the upstream must
+# not compress them
+UPSTREAM_STREAM_HEADERS: dict = {}
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global _http_client
-    _http_client = httpx.AsyncClient(timeout=httpx.Timeout(connect=10, read=300, write=30, pool=10))
+    global _http_client, UPSTREAM_HEADERS, UPSTREAM_STREAM_HEADERS
+    UPSTREAM_HEADERS = {
+        "Authorization": f"Bearer {settings.UPSTREAM_API_KEY}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+    }
+    UPSTREAM_STREAM_HEADERS = {**UPSTREAM_HEADERS, "Accept-Encoding": "identity"}
+    # HTTP/2 multiplexes concurrent streams over a few kept-alive connections
+    _http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(connect=10, read=300, write=30, pool=10),
+        limits=httpx.Limits(
+            max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+    )
+    await bm.init()
     logger.info("AI Firewall started — upstream: %s", settings.UPSTREAM_BASE_URL)
     yield
     await _http_client.aclose()
@@ -36,7 +57,12 @@ async def lifespan(app: FastAPI):
     logger.info("AI Firewall shut down.")
 
 
-app = FastAPI(title="AI Firewall", version="1.0.0", lifespan=lifespan)
+app = FastAPI(
+    title="AI Firewall",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 security = HTTPBearer()
 
 # ── Dependencies ─────────────────────────────────────────────────────────────
@@ -70,27 +96,25 @@ async def enforce_budget(user: str = Depends(verify_api_key)) -> str:
 # ── Helpers ──────────────────────────────────────────────────────────────────
 
 
-def _build_upstream_headers() -> dict:
-    """Headers forwarded to the upstream provider."""
-    return {
-        "Authorization": f"Bearer {settings.UPSTREAM_API_KEY}",
-        "Content-Type": "application/json",
-        "Accept": "text/event-stream",
-    }
-
-
 async def _count_and_bill(
     user: str,
     model: str,
-    input_tokens: int,
-    sse_chunks: List[str],
+    messages: list,
+    sse: bm.SSEBillingParser,
 ) -> None:
-    """Background task: extract output text, count tokens, update budget."""
+    """Background task: read or count tokens, update budget."""
     try:
-        output_text = bm.extract_text_from_sse_chunks(sse_chunks)
-        output_tokens = bm.count_tokens_text(output_text)
+        # Prefer provider-reported usage; only tokenize when it is absent
+        usage = sse.usage or {}
+        input_tokens = usage.get("prompt_tokens")
+        if input_tokens is None:
+            input_tokens = bm.count_tokens_for_messages(messages)
+        output_tokens = usage.get("completion_tokens")
+        if output_tokens is None:
+            output_text = sse.output_text()
+            output_tokens = bm.count_tokens_text(output_text)
         cost = bm.compute_cost(model, input_tokens, output_tokens)
-        await bm.increment_spend(user, cost)
+        bm.increment_spend(user, cost)
         logger.info(
             "Billing — user=%s model=%s in=%d out=%d cost=$%.6f",
             user, model, input_tokens, output_tokens, cost,
@@ -106,68 +130,82 @@ async def _count_and_bill(
 async def chat_completions(request: Request, user: str = Depends(enforce_budget)):
     body = await request.body()
     try:
-        payload = json.loads(body)
-    except json.JSONDecodeError:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON body")
 
     model: str = payload.get("model", "unknown")
     messages: list = payload.get("messages", [])
     is_stream: bool = payload.get("stream", False)
 
-    # Count input tokens upfront
-    input_tokens = bm.count_tokens_for_messages(messages)
-
     upstream_url = f"{settings.UPSTREAM_BASE_URL}/v1/chat/completions"
-    headers = _build_upstream_headers()
 
     if is_stream:
+        # Ask the provider to report usage on the final event so billing can
+        # skip tokenizing the generated text
+        stream_options = payload.get("stream_options") or {}
+        if not isinstance(stream_options, dict):
+            raise HTTPException(status_code=400, detail="stream_options must be an object")
+        # Clients that did not ask for usage must not see the extra event
+        strip_usage = not stream_options.get("include_usage")
+        payload["stream_options"] = {**stream_options, "include_usage": True}
+        body = orjson.dumps(payload)
         return await _handle_streaming(
-            upstream_url, headers, body, user, model, input_tokens
+            upstream_url, body, user, model, messages, strip_usage
         )
     else:
         return await _handle_non_streaming(
-            upstream_url, headers, body, user, model, input_tokens
+            upstream_url, body, user, model, messages
         )
 
 
 async def _handle_streaming(
     url: str,
-    headers: dict,
     body: bytes,
     user: str,
     model: str,
-    input_tokens: int,
+    messages: list,
+    strip_usage: bool,
 ) -> StreamingResponse:
-    """Stream SSE from upstream to client, accumulate chunks for billing."""
+    """Stream SSE from upstream to client, parsing events for billing as they pass."""
 
-    collected_chunks: List[str] = []
+    sse = bm.SSEBillingParser(strip_usage=strip_usage)
 
     async def event_generator():
+        finished = False
         try:
-            req = _http_client.build_request("POST", url, headers=headers, content=body)
-            resp = await _http_client.send(req, stream=True)
-
-            if resp.status_code != 200:
-                error_body = await resp.aread()
-                await resp.aclose()
-                # Yield a single error event so the client sees the upstream error
-                yield f"data: {json.dumps({'error': {'message': error_body.decode(), 'status': resp.status_code}})}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-
-            async for chunk in resp.aiter_text():
-                collected_chunks.append(chunk)
-                yield chunk
-
-            await resp.aclose()
+            # The context manager closes the upstream response on every exit,
+            # including a client disconnect mid-stream
+            async with _http_client.stream(
+                "POST", url, headers=UPSTREAM_STREAM_HEADERS, content=body
+            ) as resp:
+                if resp.status_code != 200:
+                    error_body = await resp.aread()
+                    # Yield a single error event so the client sees the upstream error
+                    yield f"data: {orjson.dumps({'error': {'message': error_body.decode(), 'status': resp.status_code}}).decode()}\n\n"
+                    yield "data: [DONE]\n\n"
+                    return
+
+                async for chunk in resp.aiter_raw():
+                    forward = sse.feed(chunk)
+                    if forward:
+                        yield forward
+                tail = sse.finish()
+                finished = True
+                if tail:
+                    yield tail
         except httpx.HTTPError as exc:
             logger.error("Upstream connection error: %s", exc)
-            yield f"data: {json.dumps({'error': {'message': str(exc), 'type': 'proxy_error'}})}\n\n"
+            yield f"data: {orjson.dumps({'error': {'message': str(exc), 'type': 'proxy_error'}}).decode()}\n\n"
             yield "data: [DONE]\n\n"
         finally:
+            if not finished:
+                # The stream was cut short: parse the held-back bytes so they
+                # are still billed, but don't forward a partial event
+                sse.finish()
             # Fire-and-forget billing task
             asyncio.create_task(
-                _count_and_bill(user, model, input_tokens, collected_chunks)
+                _count_and_bill(user, model, messages, sse)
             )
 
     return StreamingResponse(
@@ -183,37 +221,46 @@ async def _handle_streaming(
 
 async def _handle_non_streaming(
     url: str,
-    headers: dict,
     body: bytes,
     user: str,
     model: str,
-    input_tokens: int,
-) -> JSONResponse:
-    """Proxy a non-streaming request, bill from the usage field."""
+    messages: list,
+) -> Response:
+    """Proxy a non-streaming request, bill from the usage field.
+
+    The upstream body is forwarded verbatim; it is only parsed to read usage.
+    """
     try:
-        resp = await _http_client.request("POST", url, headers=headers, content=body)
+        resp = await _http_client.request(
+            "POST", url, headers=UPSTREAM_HEADERS, content=body
+        )
     except httpx.HTTPError as exc:
         logger.error("Upstream error: %s", exc)
         raise HTTPException(status_code=502, detail=f"Upstream error: {exc}")
 
+    raw = resp.content
+    media_type = resp.headers.get("content-type", "application/json")
     if resp.status_code != 200:
-        return JSONResponse(content=resp.json(), status_code=resp.status_code)
-
-    data = resp.json()
+        return Response(content=raw, status_code=resp.status_code, media_type=media_type)
 
     # Use provider-reported usage if available, else estimate
-    usage = data.get("usage", {})
+    try:
+        usage = orjson.loads(raw).get("usage") or {}
+    except (orjson.JSONDecodeError, AttributeError):
+        usage = {}
     out_tokens = usage.get("completion_tokens", 0)
-    in_tokens = usage.get("prompt_tokens", input_tokens)
+    in_tokens = usage.get("prompt_tokens")
+    if in_tokens is None:
+        in_tokens = bm.count_tokens_for_messages(messages)
 
     cost = bm.compute_cost(model, in_tokens, out_tokens)
-    await bm.increment_spend(user, cost)
+    bm.increment_spend(user, cost)
     logger.info(
         "Billing (sync) — user=%s model=%s in=%d out=%d cost=$%.6f",
         user, model, in_tokens, out_tokens, cost,
     )
 
-    return JSONResponse(content=data, status_code=200)
+    return Response(content=raw, status_code=200, media_type=media_type)
 
 
 # ── Health check ─────────────────────────────────────────────────────────────
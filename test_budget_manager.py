@@ -0,0 +1,232 @@
+import asyncio
+
+import pytest
+
+import budget_manager as bm
+
+USAGE = {"prompt_tokens": 12, "completion_tokens": 7, "total_tokens": 19}
+
+DONE = b"data: [DONE]\n\n"
+USAGE_EVENT = (
+    b'data: {"choices":[],"usage":{"prompt_tokens":12,"completion_tokens":7,'
+    b'"total_tokens":19}}\n\n'
+)
+
+STREAMS = {
+    "escaped_quotes_and_backslashes": (
+        b'data: {"choices":[{"delta":{"role":"assistant","content":""}}],"usage":null}\n\n'
+        b'data: {"choices":[{"delta":{"content":"say \\"hi\\" "}}],"usage":null}\n\n'
+        b'data: {"choices":[{"delta":{"content":"C:\\\\dir\\\\"}}],"usage":null}\n\n'
+        + USAGE_EVENT + DONE,
+        'say "hi" C:\\dir\\',
+        USAGE,
+    ),
+    "non_ascii": (
+        'data: {"choices":[{"delta":{"content":"héllo 世界 "}}]}\n\n'.encode()
+        + b'data: {"choices":[{"delta":{"content":"caf\\u00e9 \\ud83d\\ude00"}}]}\n\n'
+        + DONE,
+        "héllo 世界 café 😀",
+        None,
+    ),
+    "multiple_choices": (
+        b'data: {"choices":[{"index":0,"delta":{"content":"a"}},'
+        b'{"index":1,"delta":{"content":"b"}}]}\n\n'
+        b'data: {"choices":[{"index":0,"delta":{"content":"c"}}]}\n\n'
+        + DONE,
+        "abc",
+        None,
+    ),
+    "tool_call_arguments_mention_content": (
+        b'data: {"choices":[{"delta":{"content":null,"tool_calls":[{"index":0,'
+        b'"function":{"name":"save","arguments":""}}]}}]}\n\n'
+        b'data: {"choices":[{"delta":{"tool_calls":[{"index":0,'
+        b'"function":{"arguments":"{\\"content\\":\\"x\\"}"}}]}}]}\n\n'
+        b'data: {"choices":[{"delta":{"content":"done"}}]}\n\n'
+        + DONE,
+        "done",
+        None,
+    ),
+    "trailing_event_without_newline": (
+        b'data: {"choices":[{"delta":{"content":"one "}}]}\n\n'
+        b'data: {"choices":[{"delta":{"content":"two"}}]}',
+        "one two",
+        None,
+    ),
+    "crlf_line_endings": (
+        b'data: {"choices":[{"delta":{"content":"x"}}],"usage":null}\r\n\r\n'
+        b': keep-alive\r\n\r\n'
+        b'data: {"choices":[{"delta":{"content": "y"}}],"usage":null}\r\n\r\n'
+        + USAGE_EVENT.replace(b"\n", b"\r\n")
+        + b"data: [DONE]\r\n\r\n",
+        "xy",
+        USAGE,
+    ),
+}
+
+
+def _feed(parser, stream, offset):
+    out = parser.feed(stream[:offset])
+    out += parser.feed(stream[offset:])
+    return out + parser.finish()
+
+
+@pytest.mark.parametrize("name", STREAMS)
+def test_parser_every_split_offset(name):
+    stream, text, usage = STREAMS[name]
+    for offset in range(len(stream) + 1):
+        parser = bm.SSEBillingParser()
+        forwarded = _feed(parser, stream, offset)
+        assert parser.output_text() == text, offset
+        assert parser.usage == usage, offset
+        assert forwarded == stream, offset
+
+
+@pytest.mark.parametrize("name", STREAMS)
+def test_parser_byte_at_a_time(name):
+    stream, text, usage = STREAMS[name]
+    parser = bm.SSEBillingParser()
+    for i in range(len(stream)):
+        parser.feed(stream[i:i + 1])
+    parser.finish()
+    assert parser.output_text() == text
+    assert parser.usage == usage
+
+
+@pytest.mark.parametrize("name", STREAMS)
+def test_strip_usage_removes_only_usage_event(name):
+    stream, text, usage = STREAMS[name]
+    expected = stream.replace(USAGE_EVENT, b"").replace(
+        USAGE_EVENT.replace(b"\n", b"\r\n"), b""
+    )
+    for offset in range(len(stream) + 1):
+        parser = bm.SSEBillingParser(strip_usage=True)
+        assert _feed(parser, stream, offset) == expected, offset
+        assert parser.output_text() == text, offset
+        assert parser.usage == usage, offset
+
+
+def test_malformed_fragment_only_drops_its_event():
+    stream = (
+        b'data: {"choices":[{"delta":{"content":"ok"}}]}\n\n'
+        b'data: {"choices":[{"delta":{"content":"bad\\q"}}]}\n\n'
+        b'data: {"choices":[{"delta":{"content":"!"}}]}\n\n'
+    )
+    parser = bm.SSEBillingParser()
+    parser.feed(stream)
+    parser.finish()
+    assert parser.output_text() == "ok!"
+
+
+@pytest.mark.parametrize(
+    "event",
+    [
+        b'data: {"choices":5,"usage":{"completion_tokens":3}}\n\n',
+        b'data: {"choices":[5],"usage":{"completion_tokens":3}}\n\n',
+        b'data: {"choices":[{"delta":[1]}],"usage":{"completion_tokens":3}}\n\n',
+        b'data: [1, "content"]\n\n',
+        b'data: "content"\n\n',
+    ],
+)
+def test_parser_never_raises_on_unexpected_event_shapes(event):
+    stream = event + b'data: {"choices":[{"delta":{"content":"ok"}}]}\n\n'
+    for strip_usage in (False, True):
+        parser = bm.SSEBillingParser(strip_usage=strip_usage)
+        assert parser.feed(stream) == stream
+        assert parser.finish() == b""
+        assert parser.output_text() == "ok"
+
+
+@pytest.mark.parametrize(
+    "model, prices",
+    [
+        ("gpt-4o", bm.COST_PER_TOKEN["gpt-4o"]),
+        ("openai/gpt-4o", bm.COST_PER_TOKEN["gpt-4o"]),
+        ("some/unknown-model", bm.DEFAULT_PER_TOKEN),
+        (None, bm.DEFAULT_PER_TOKEN),
+        (["gpt-4o"], bm.DEFAULT_PER_TOKEN),
+    ],
+)
+def test_compute_cost_model_lookup(model, prices):
+    input_price, output_price = prices
+    expected = 1000 * input_price + 500 * output_price
+    assert bm.compute_cost(model, 1000, 500) == pytest.approx(expected)
+
+
+def _run_flusher(monkeypatch, flush):
+    calls = []
+
+    async def recording_flush(pending):
+        calls.append(dict(pending))
+        return await flush(len(calls), pending)
+
+    monkeypatch.setattr(bm, "_flush_spend", recording_flush)
+    monkeypatch.setattr(bm, "SPEND_RETRY_INTERVAL", 0)
+
+    async def run():
+        monkeypatch.setattr(bm, "_spend_queue", asyncio.Queue())
+        task = asyncio.create_task(bm._spend_flusher())
+        bm.increment_spend("alice", 1.0)
+        bm.increment_spend("bob", 2.0)
+        await asyncio.sleep(0.05)
+        bm.increment_spend("alice", 0.5)
+        bm._spend_queue.put_nowait(None)
+        await task
+
+    asyncio.run(run())
+    return calls
+
+
+def test_flusher_retries_batches_that_were_not_sent(monkeypatch):
+    async def flush(call, pending):
+        if call == 1:
+            raise bm._SpendNotSent()
+        return {}
+
+    # Nothing reached Redis, so the whole batch is retried before later ones
+    assert _run_flusher(monkeypatch, flush) == [
+        {"alice": 1.0, "bob": 2.0},
+        {"alice": 1.0, "bob": 2.0},
+        {"alice": 0.5},
+    ]
+
+
+def test_flusher_drops_batches_whose_reply_was_lost(monkeypatch):
+    async def flush(call, pending):
+        if call == 1:
+            # Sent and probably applied, but the reply timed out
+            raise TimeoutError("read timed out")
+        return {}
+
+    # Retrying could bill alice and bob twice
+    assert _run_flusher(monkeypatch, flush) == [
+        {"alice": 1.0, "bob": 2.0},
+        {"alice": 0.5},
+    ]
+
+
+def test_flush_spend_only_returns_noscript_failures(monkeypatch):
+    from redis.exceptions import NoScriptError, ResponseError
+
+    class FakeRedis:
+        async def script_load(self, script):
+            return "reloaded"
+
+    async def eval_spend(items):
+        return [
+            NoScriptError("NOSCRIPT"),
+            ResponseError("WRONGTYPE"),
+            ["3.5", 0],
+        ]
+
+    monkeypatch.setattr(bm, "REDIS", FakeRedis())
+    monkeypatch.setattr(bm, "_eval_spend", eval_spend)
+    monkeypatch.setattr(bm, "_spend_sha", "stale")
+    monkeypatch.setattr(bm, "_spent_cache", {})
+
+    pending = {"alice": 1.0, "bob": 2.0, "carol": 0.5}
+    failed = asyncio.run(bm._flush_spend(pending))
+
+    assert failed == {"alice": 1.0}
+    assert bm._spend_sha == "reloaded"
+    assert bm._spent_cache["carol"][0] == 3.5
+    assert "bob" not in bm._spent_cache
@@ -0,0 +1,78 @@
+import asyncio
+
+import httpx
+
+import budget_manager as bm
+import main
+
+STREAM = (
+    b'data: {"choices":[{"delta":{"content":"Hel"}}],"usage":null}\n\n'
+    b'data: {"choices":5,"usage":{"completion_tokens":1}}\n\n'
+    b'data: {"choices":[{"delta":{"content":"lo"}}],"usage":null}\n\n'
+    b'data: {"choices":[],"usage":{"prompt_tokens":4,"completion_tokens":2}}\n\n'
+    b"data: [DONE]\n\n"
+)
+
+
+class TrackedStream(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+def _proxy(monkeypatch, upstream, consume):
+    billed = []
+    monkeypatch.setattr(bm, "increment_spend", lambda user, cost: billed.append(cost))
+
+    async def run():
+        client = httpx.AsyncClient(
+            transport=httpx.MockTransport(
+                lambda request: httpx.Response(200, stream=upstream)
+            )
+        )
+        monkeypatch.setattr(main, "_http_client", client)
+        response = await main._handle_streaming(
+            "http://upstream/v1/chat/completions", b"{}", "default", "gpt-4o", [], True
+        )
+        body = await consume(response.body_iterator)
+        # Let the fire-and-forget billing task run
+        await asyncio.sleep(0)
+        await client.aclose()
+        return body
+
+    return asyncio.run(run()), billed
+
+
+def test_streaming_forwards_full_response_and_closes_upstream(monkeypatch):
+    upstream = TrackedStream([STREAM[i:i + 7] for i in range(0, len(STREAM), 7)])
+
+    async def consume(iterator):
+        return b"".join([chunk async for chunk in iterator])
+
+    body, billed = _proxy(monkeypatch, upstream, consume)
+
+    # The injected usage event is hidden, the odd event is passed through
+    assert body == STREAM.replace(
+        b'data: {"choices":[],"usage":{"prompt_tokens":4,"completion_tokens":2}}\n\n', b""
+    )
+    assert upstream.closed
+    assert billed == [bm.compute_cost("gpt-4o", 4, 2)]
+
+
+def test_streaming_client_disconnect_closes_upstream(monkeypatch):
+    upstream = TrackedStream([STREAM[:60], STREAM[60:]])
+
+    async def consume(iterator):
+        first = await iterator.__anext__()
+        await iterator.aclose()
+        return first
+
+    _proxy(monkeypatch, upstream, consume)
+    assert upstream.closed